@@ -1,21 +1,36 @@
 import os
-import shutil
+import sys
 import time
+import threading
 from datetime import datetime
 import re
 import logging
+import logging.handlers
+import queue
 import hashlib
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import PatternMatchingEventHandler
 
-# Configure logging
+try:
+    import hyperscan  # Optional: faster PCB line scanning on Linux
+except ImportError:
+    hyperscan = None
+
+# Configure logging; records are queued and written by a background listener
+# so event handling never waits on the log file
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+log_handlers = [
+    logging.FileHandler(os.path.join(r"C:\spi\backup", "pcb_counter.log")),
+    logging.StreamHandler()
+]
+for log_handler in log_handlers:
+    log_handler.setFormatter(log_formatter)
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(os.path.join(r"C:\spi\backup", "pcb_counter.log")),
-        logging.StreamHandler()
-    ]
+    format='%(message)s',  # Full formatting happens in the listener's handlers
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
 logger = logging.getLogger(__name__)
 
@@ -26,21 +41,60 @@ BACKUP_LOG_PATH = os.path.join(BACKUP_DIR, "spi_log_backup.his")
 COUNT_FILE_PATH = os.path.join(BACKUP_DIR, "pcb_daily_count.txt")
 PCB_LINES_PATH = os.path.join(BACKUP_DIR, "pcb_lines.txt")  # Debug file for PCB lines
 TOTAL_PCB_FILE = os.path.join(BACKUP_DIR, "total_pcb_ids.txt")  # Persistent total PCB IDs
-PCB_ID_PATTERN = r"PCB.*(\d+)"           # Primary regex
-FALLBACK_PATTERN = r"[Pp][Cc][Bb].*?(\d+)"  # Fallback regex
-DELAY_SECONDS = 0.5                      # Delay to ensure file write completion
+PCB_LINE_PATTERN = rb"^.*PCB.*$"         # Lines mentioning PCB, matched on raw bytes
+PCB_ID_PATTERN = r"PCB[^\d\n]{0,32}(\d+)"  # Bounded: no greedy backtracking
+DELAY_SECONDS = 0.5                      # Quiet period before processing a burst of writes
+MAX_DELAY_SECONDS = 5                    # Longest a steady stream of writes can hold off processing
+CHUNK_SIZE = 8 * 1024 * 1024             # Bytes of new log data read and scanned at a time
+SORT_INTERVAL_SECONDS = 600              # How often total_pcb_ids.txt is rewritten sorted
+UTF16_BOMS = {b'\xff\xfe': 'utf-16-le', b'\xfe\xff': 'utf-16-be'}
+
+# Compiled once at import instead of on every filesystem event
+PCB_LINE_RE = re.compile(PCB_LINE_PATTERN, re.IGNORECASE | re.MULTILINE)
+PCB_ID_RE = re.compile(PCB_ID_PATTERN, re.IGNORECASE)
+
+def compile_pcb_database():
+    """Compile a Hyperscan database matching PCB, or return None to scan with re."""
+    if hyperscan is None or not sys.platform.startswith('linux'):
+        return None
+    try:
+        database = hyperscan.Database()
+        database.compile(expressions=[b'PCB'], ids=[0], elements=1, flags=[hyperscan.HS_FLAG_CASELESS])
+        return database
+    except Exception as e:
+        logger.warning(f"Could not compile Hyperscan database, scanning with re: {e}")
+        return None
+
+PCB_HS_DATABASE = compile_pcb_database()
+
+class LogFileHandler(PatternMatchingEventHandler):
+    pcb_line_re = PCB_LINE_RE
+    pcb_id_re = PCB_ID_RE
+    pcb_hs_database = PCB_HS_DATABASE
 
-class LogFileHandler(FileSystemEventHandler):
     def __init__(self):
+        # Let watchdog drop events for other files in the directory before they reach on_modified
+        super().__init__(patterns=[SOURCE_LOG_PATH], ignore_directories=True, case_sensitive=False)
         self.total_pcb_ids = self.load_total_pcb_ids()
+        self.unsorted_pcb_ids = []    # Appended to TOTAL_PCB_FILE since it was last sorted
+        self.last_sorted_save = time.monotonic()
+        self.needs_full_save = False  # An append failed, so only a full rewrite restores the file
         self.current_date = datetime.now().date()
+        self.read_offset = 0          # Bytes of the log already processed
+        self.last_source_size = None  # Source size at the last copy
+        self.last_written_count = None  # Count last written to COUNT_FILE_PATH
+        self.log_encoding = 'utf-8'   # Detected from the BOM when reading from the start
+        self.pending_timer = None
+        self.pending_since = None     # When the first event of the pending burst arrived
+        self.timer_lock = threading.Lock()
+        self.process_lock = threading.Lock()
         
     def load_total_pcb_ids(self):
         """Load total PCB IDs from persistent file."""
         try:
             if os.path.exists(TOTAL_PCB_FILE):
                 with open(TOTAL_PCB_FILE, 'r', encoding='utf-8') as f:
-                    return set(line.strip() for line in f if line.strip().isdigit())
+                    return set(int(line) for line in f if line.strip().isdecimal())
             return set()
         except Exception as e:
             logger.error(f"Error loading total PCB IDs: {e}")
@@ -49,18 +103,120 @@ class LogFileHandler(FileSystemEventHandler):
     def save_total_pcb_ids(self):
         """Save total PCB IDs to persistent file."""
         try:
-            with open(TOTAL_PCB_FILE, 'w', encoding='utf-8') as f:
-                for pcb_id in sorted(self.total_pcb_ids, key=int):
+            # Swap in a complete file so a failed write never leaves the IDs truncated
+            tmp_path = TOTAL_PCB_FILE + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for pcb_id in sorted(self.total_pcb_ids):
                     f.write(f"{pcb_id}\n")
+            os.replace(tmp_path, TOTAL_PCB_FILE)
+            self.unsorted_pcb_ids = []
+            self.needs_full_save = False
+            self.last_sorted_save = time.monotonic()
             logger.info(f"Saved {len(self.total_pcb_ids)} total PCB IDs to {TOTAL_PCB_FILE}")
         except Exception as e:
             logger.error(f"Error saving total PCB IDs: {e}")
+            self.needs_full_save = True
+
+    def append_total_pcb_ids(self, pcb_ids):
+        """Append new PCB IDs to the persistent file, rewriting it sorted every SORT_INTERVAL_SECONDS
+        or after a failed write."""
+        self.unsorted_pcb_ids.extend(pcb_ids)
+        if not self.needs_full_save:
+            try:
+                with open(TOTAL_PCB_FILE, 'a', encoding='utf-8') as f:
+                    f.write("".join(f"{pcb_id}\n" for pcb_id in pcb_ids))
+                logger.info(f"Appended {len(pcb_ids)} PCB IDs to {TOTAL_PCB_FILE}")
+            except Exception as e:
+                logger.error(f"Error appending total PCB IDs: {e}")
+                self.needs_full_save = True
+        if self.needs_full_save or time.monotonic() - self.last_sorted_save >= SORT_INTERVAL_SECONDS:
+            self.save_total_pcb_ids()
 
     def on_modified(self, event):
-        if event.src_path == SOURCE_LOG_PATH and not event.is_directory:
-            time.sleep(DELAY_SECONDS)
+        # Restart the timer so a burst of writes is processed once it goes quiet,
+        # but stop restarting it once the burst has waited MAX_DELAY_SECONDS
+        with self.timer_lock:
+            now = time.monotonic()
+            if self.pending_timer is not None:
+                if now - self.pending_since >= MAX_DELAY_SECONDS:
+                    return
+                self.pending_timer.cancel()
+            else:
+                self.pending_since = now
+            self.pending_timer = threading.Timer(DELAY_SECONDS, self.process_pending)
+            self.pending_timer.daemon = True
+            self.pending_timer.start()
+
+    def process_pending(self):
+        # Events from here on start a new burst
+        with self.timer_lock:
+            if self.pending_timer is threading.current_thread():
+                self.pending_timer = None
+        with self.process_lock:
             self.process_log_file()
 
+    def cancel_pending(self):
+        with self.timer_lock:
+            if self.pending_timer is not None:
+                self.pending_timer.cancel()
+                self.pending_timer = None
+
+    def stop(self):
+        """Cancel pending processing and leave the total PCB IDs file sorted."""
+        self.cancel_pending()
+        with self.process_lock:
+            if self.unsorted_pcb_ids:
+                self.save_total_pcb_ids()
+
+    def read_new_chunks(self):
+        """Yield (chunk, end_offset) for complete lines appended to the source log, about
+        CHUNK_SIZE bytes at a time.
+
+        The caller moves read_offset to end_offset only once the chunk is handled, so a chunk
+        that fails is read again on the next pass. A trailing partial line is left for the
+        next pass so IDs are not cut in half.
+        """
+        with open(SOURCE_LOG_PATH, 'rb') as source_file:
+            if self.read_offset == 0:
+                self.log_encoding = UTF16_BOMS.get(source_file.read(2), 'utf-8')
+            offset = self.read_offset
+            source_file.seek(offset)
+            newline = '\n'.encode(self.log_encoding)
+            partial = b''
+            while True:
+                data = source_file.read(CHUNK_SIZE)
+                if not data:
+                    break
+                data = partial + data
+                end = data.rfind(newline)
+                if end == -1:
+                    partial = data
+                    continue
+                end += len(newline)
+                partial = data[end:]
+                offset += end
+                yield data[:end], offset
+
+    def find_pcb_lines(self, data):
+        """Return the lines of data that mention PCB, as bytes."""
+        if self.pcb_hs_database is None:
+            return self.pcb_line_re.findall(data)
+
+        # Hyperscan reports where each PCB ends; expand each hit to its line, once per line
+        lines = []
+        line_end = -1
+        def on_match(pattern_id, start, end, flags, context):
+            nonlocal line_end
+            if end <= line_end:
+                return
+            line_start = data.rfind(b'\n', 0, end) + 1
+            line_end = data.find(b'\n', end)
+            if line_end == -1:
+                line_end = len(data)
+            lines.append(data[line_start:line_end])
+        self.pcb_hs_database.scan(data, match_event_handler=on_match)
+        return lines
+
     def process_log_file(self):
         # Check if date has changed (for logging and count file)
         current_date = datetime.now().date()
@@ -69,106 +225,139 @@ class LogFileHandler(FileSystemEventHandler):
             self.current_date = current_date
             self.update_count_file()
 
-        # Copy source file to backup
+        # Check the source file; new data is found by offset since the log is append-only
         try:
-            if not os.path.exists(SOURCE_LOG_PATH):
+            # One stat call answers both whether the file exists and how big it is
+            try:
+                source_size = os.stat(SOURCE_LOG_PATH).st_size
+            except FileNotFoundError:
                 logger.warning(f"Source file {SOURCE_LOG_PATH} does not exist.")
                 self.update_count_file()
                 return
-            shutil.copy2(SOURCE_LOG_PATH, BACKUP_LOG_PATH)
-            logger.info(f"Backed up {SOURCE_LOG_PATH} to {BACKUP_LOG_PATH}")
+            # An unchanged size means nothing new to process
+            if source_size == self.last_source_size:
+                logger.debug("Source file size unchanged. Skipping processing.")
+                return
+            self.last_source_size = source_size
+            if source_size < self.read_offset:
+                logger.info("Log file was truncated. Rescanning from the start.")
+                self.read_offset = 0
+            if source_size == 0:
+                logger.warning("Source file is empty. Skipping processing.")
+                self.update_count_file()
+                return
         except Exception as e:
-            logger.error(f"Error copying source file to backup: {e}")
+            logger.error(f"Error checking source file: {e}")
+            self.last_source_size = None
             self.update_count_file()
             return
 
-        # Read and process backup file
+        # Back up and scan the new lines chunk by chunk so memory stays bounded on large logs
         try:
-            file_size = os.path.getsize(BACKUP_LOG_PATH)
-            if file_size == 0:
-                logger.warning("Backup file is empty. Skipping processing.")
-                self.update_count_file()
-                return
-                
-            # Try reading as text with different encodings
-            content = None
-            content_hash = None
-            for encoding in ['utf-8', 'latin1', 'ascii', 'utf-16', 'utf-16-le', 'utf-16-be']:
-                try:
-                    with open(BACKUP_LOG_PATH, 'r', encoding=encoding, errors='ignore') as backup_file:
-                        content = backup_file.read()
-                        content_hash = hashlib.md5(content.encode('utf-8', errors='ignore')).hexdigest()
-                        logger.info(f"Read {len(content)} characters from backup file using {encoding} encoding. MD5: {content_hash}")
-                        break
-                except Exception as e:
-                    logger.warning(f"Failed to read with {encoding} encoding: {e}")
-            
-            # Fallback: Read as binary
-            if content is None:
-                try:
-                    with open(BACKUP_LOG_PATH, 'rb') as backup_file:
-                        raw_content = backup_file.read()
-                        content = raw_content.decode('utf-8', errors='ignore')
-                        content_hash = hashlib.md5(content.encode('utf-8', errors='ignore')).hexdigest()
-                        logger.info(f"Read {len(content)} characters from backup file as binary (decoded utf-8). MD5: {content_hash}")
-                except Exception as e:
-                    logger.error(f"Failed to read backup file as binary: {e}")
-                    self.update_count_file()
-                    return
+            debug = logger.isEnabledFor(logging.DEBUG)
+            from_start = self.read_offset == 0
+            md5 = hashlib.md5()
+            bytes_read = 0
+            pcb_id_count = 0
+            pcb_line_count = 0
+            new_pcb_count = 0
+            pcb_lines_mode = 'w' if from_start else 'a'
+            # The backup mirrors the processed part of the source
+            with open(BACKUP_LOG_PATH, 'wb' if from_start else 'ab') as backup_file:
+                for raw_content, end_offset in self.read_new_chunks():
+                    first_chunk = not bytes_read
+                    bytes_read += len(raw_content)
+                    if debug:
+                        md5.update(raw_content)
+                    # UTF-16 is transcoded so the byte-level scan below sees ASCII "PCB"
+                    scan_content = raw_content
+                    if self.log_encoding != 'utf-8':
+                        scan_content = raw_content.decode(self.log_encoding, errors='ignore').encode('utf-8')
+                    if debug and first_chunk:
+                        log_lines = scan_content.split(b'\n', 500)[:500]
+                        logger.debug("First %d new lines of log file:\n%s", len(log_lines),
+                                     b'\n'.join(log_lines).decode('utf-8', errors='ignore'))
 
-            # Log first 500 lines or full content
-            lines = content.splitlines()
-            log_lines = lines[:500] if len(lines) > 500 else lines
-            logger.debug(f"First {len(log_lines)} lines of backup file:\n{chr(10).join(log_lines)}")
+                    # Only lines mentioning PCB are decoded and searched for IDs
+                    chunk_pcb_ids = []
+                    chunk_pcb_lines = []
+                    for line in self.find_pcb_lines(scan_content):
+                        line = line.decode('utf-8', errors='ignore').strip()
+                        chunk_pcb_lines.append(line)
+                        match = self.pcb_id_re.search(line)
+                        if match:
+                            chunk_pcb_ids.append(int(match.group(1)))
+                    pcb_id_count += len(chunk_pcb_ids)
+                    pcb_line_count += len(chunk_pcb_lines)
+                    if debug and chunk_pcb_ids:
+                        logger.debug("PCB IDs: %s", chunk_pcb_ids)
 
-            # Extract PCB IDs
-            pcb_ids = re.findall(PCB_ID_PATTERN, content, re.IGNORECASE)
-            if not pcb_ids:
-                logger.warning("No PCB IDs found with primary pattern. Trying fallback.")
-                pcb_ids = re.findall(FALLBACK_PATTERN, content, re.IGNORECASE)
-            
-            pcb_lines = [line.strip() for line in lines if "PCB" in line.lower() or "pcb" in line]
-            
-            # Log PCB-related lines to separate file
-            try:
-                with open(PCB_LINES_PATH, 'w', encoding='utf-8') as pcb_file:
-                    pcb_file.write(f"Date: {datetime.now()}\n")
-                    pcb_file.write(f"PCB-related lines ({len(pcb_lines)}):\n")
-                    for line in pcb_lines:
-                        pcb_file.write(f"{line}\n")
-                logger.info(f"Wrote {len(pcb_lines)} PCB-related lines to {PCB_LINES_PATH}")
-            except Exception as e:
-                logger.error(f"Error writing to PCB lines file: {e}")
+                    # Save the chunk's new IDs and PCB lines before backing it up and moving the
+                    # offset past it, so a chunk that fails is scanned again on the next pass
+                    new_pcb_ids = set(chunk_pcb_ids) - self.total_pcb_ids
+                    if new_pcb_ids:
+                        self.total_pcb_ids |= new_pcb_ids
+                        self.append_total_pcb_ids(sorted(new_pcb_ids))
+                        new_pcb_count += len(new_pcb_ids)
+                    # A pass from the start of the log starts the PCB lines file over
+                    if chunk_pcb_lines or pcb_lines_mode == 'w':
+                        try:
+                            with open(PCB_LINES_PATH, pcb_lines_mode, encoding='utf-8') as pcb_file:
+                                if chunk_pcb_lines:
+                                    pcb_file.write(
+                                        f"Date: {datetime.now()}\n"
+                                        f"PCB-related lines ({len(chunk_pcb_lines)}):\n"
+                                        + "".join(f"{line}\n" for line in chunk_pcb_lines)
+                                    )
+                            pcb_lines_mode = 'a'
+                        except Exception as e:
+                            logger.error(f"Error writing to PCB lines file: {e}")
+                    backup_file.write(raw_content)
+                    self.read_offset = end_offset
 
-            if not pcb_ids:
-                logger.warning("No PCB IDs found. Check PCB lines in pcb_lines.txt.")
-                if pcb_lines:
-                    logger.debug(f"Found {len(pcb_lines)} lines containing 'PCB':\n{chr(10).join(pcb_lines)}")
+            if not bytes_read:
+                logger.debug("No new complete lines in source file.")
+                self.update_count_file()
+                return
+            logger.info(f"Backed up and read {bytes_read} new bytes of {SOURCE_LOG_PATH} using {self.log_encoding} encoding.")
+            if debug:
+                logger.debug("MD5 of new data: %s", md5.hexdigest())
+            
+            if pcb_line_count:
+                logger.info(f"Wrote {pcb_line_count} PCB-related lines to {PCB_LINES_PATH}")
+            if pcb_line_count and not pcb_id_count:
+                logger.warning("No PCB IDs found in new PCB lines. Check PCB lines in pcb_lines.txt.")
                 
-            logger.info(f"Found {len(pcb_ids)} PCB IDs: {pcb_ids}")
-            prev_total_count = len(self.total_pcb_ids)
-            self.total_pcb_ids.update(pcb_ids)
+            logger.info(f"Found {pcb_id_count} PCB IDs.")
             
-            # Save total PCB IDs
-            if len(self.total_pcb_ids) > prev_total_count:
+            # Retry a sorted save left pending by a failed write
+            if not new_pcb_count and self.needs_full_save:
                 self.save_total_pcb_ids()
             
             # Always update count file
             self.update_count_file()
-            if len(self.total_pcb_ids) > prev_total_count:
-                logger.info(f"Added {len(self.total_pcb_ids) - prev_total_count} new PCB IDs.")
+            if new_pcb_count:
+                logger.info(f"Added {new_pcb_count} new PCB IDs.")
             else:
                 logger.debug("No new PCB IDs added.")
                     
         except Exception as e:
-            logger.error(f"Error processing backup file: {e}")
+            logger.error(f"Error processing new log data: {e}")
+            self.last_source_size = None
             self.update_count_file()
 
     def update_count_file(self):
+        count = len(self.total_pcb_ids)
+        if count == self.last_written_count:
+            return
         try:
-            with open(COUNT_FILE_PATH, 'w', encoding='utf-8') as count_file:
-                count_file.write(f"{len(self.total_pcb_ids)}\n")
-            logger.info(f"Updated count file with {len(self.total_pcb_ids)} total PCBs")
+            # Swap in a complete file so readers never see a partial count
+            tmp_path = COUNT_FILE_PATH + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as count_file:
+                count_file.write(f"{count}\n")
+            os.replace(tmp_path, COUNT_FILE_PATH)
+            self.last_written_count = count
+            logger.info(f"Updated count file with {count} total PCBs")
         except PermissionError as e:
             logger.error(f"Permission error writing to count file: {e}")
         except Exception as e:
@@ -183,6 +372,7 @@ def ensure_backup_directory():
         logger.error(f"Error creating backup directory: {e}")
 
 def main():
+    log_listener.start()
     ensure_backup_directory()
     event_handler = LogFileHandler()
     
@@ -205,6 +395,7 @@ def main():
     logger.info(f"Count file: {COUNT_FILE_PATH}")
     logger.info(f"PCB lines debug file: {PCB_LINES_PATH}")
     logger.info(f"Total PCB IDs file: {TOTAL_PCB_FILE}")
+    logger.info(f"PCB line scanner: {'Hyperscan' if PCB_HS_DATABASE is not None else 're'}")
     
     try:
         while True:
@@ -213,6 +404,8 @@ def main():
         logger.info("Stopping live monitoring")
         observer.stop()
     observer.join()
+    event_handler.stop()
+    log_listener.stop()
 
 if __name__ == "__main__":
     main()